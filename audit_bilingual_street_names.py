@@ -17,224 +17,26 @@
 # (e.g. the name:en) do not.
 
 import csv
-import re
-import xml.etree.cElementTree as ET
-import string
+import sys
+import numpy as np
 import pandas as pd
 
+from osm_pipeline import (
+    create_lookups, get_official_name_list, get_street_names, iter_tags
+)
+
 OSM_FILE = 'Hong_Kong.osm'
 STREET_NAME_FILE = 'PSI_Street Name_062017.xml'
 
-NODES_PATH = 'nodes.csv'
-NODE_TAGS_PATH = 'nodes_tags.csv'
-WAYS_PATH = 'ways.csv'
-WAY_NODES_PATH = 'ways_nodes.csv'
-WAY_TAGS_PATH = 'ways_tags.csv'
-
-LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
-PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
-FIRST_COLON_RE = re.compile(r'(.*?):(.*)$')
-
-CHI_NAME_RE = re.compile(r"([^A-Za-z'\-,. ]+[0-9]?[^A-Za-z'\-,. ]+)")
-ENG_NAME_RE = re.compile(r"[ ]*([A-Za-z0-9'\-,. ]{4,})")
-
-NODE_FIELDS = [
-    'id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp'
-]
-NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
-WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
-WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
-WAY_NODES_FIELDS = ['id', 'node_id', 'position']
-
-# These are possible values for an osm way with a tag with 'highway' 
-# as key, to be a government-named street.
-STREET_VALUES = [
-    'motorway', 'trunk', 'primary', 'secondary', 'tertiary', 
-    'residential',  'living_street', 'pedestrian', 'track', 
-    'road', 'steps', 'path'
-]
-
-def shape_element(element, node_attr_fields=NODE_FIELDS, 
-                  way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
-
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    # Handle secondary tags the same way for both node and way elements
-    tags = []  
-    position = 0
-
-    for child in element:
-        if (
-            child.tag == 'tag' 
-            and not PROBLEMCHARS.search(child.attrib['k'])
-        ):
-            tag_dict = {}
-            tag_dict['id'] = element.attrib['id']
-            tag_dict['value'] = child.attrib['v']
-            m = FIRST_COLON_RE.search(child.attrib['k'])
-            if m:
-                tag_dict['key'] = m.group(2)
-                tag_dict['type'] = m.group(1)
-            else:
-                tag_dict['key'] = child.attrib['k']
-                tag_dict['type'] = 'regular'
-            tags.append(tag_dict)
-        if child.tag == 'nd':
-            way_node_dict = {}
-            way_node_dict['id'] = element.attrib['id']
-            way_node_dict['node_id'] = child.attrib['ref']
-            way_node_dict['position'] = position
-            position += 1
-            way_nodes.append(way_node_dict)
-            
-    if element.tag == 'node':
-        for attribute_name in element.attrib:
-            if attribute_name in NODE_FIELDS:
-                node_attribs[attribute_name] = (
-                    element.attrib[attribute_name]
-                )
-        return {'node': node_attribs, 'node_tags': tags}
-    elif element.tag == 'way':
-        for attribute_name in element.attrib:
-            if attribute_name in WAY_FIELDS:
-                way_attribs[attribute_name] = (
-                    element.attrib[attribute_name]
-                )
-        return {
-            'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags
-        }
-
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+# The versions of a street's name we look for in the tags of a way
+NAME_VERSIONS = ['en_only', 'reg_eng', 'zh_only', 'reg_chi']
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
-
-def get_official_name_list(street_name_file):
-    '''
-    Takes the street names xml file from the HK government, 
-    1. parse it,
-    2. capitalize the first letter of each word
-    3. delete rows with null values,
-    4. delete duplicate rows and leaving only one copy,
-    5. delete rows that share the same value for either the English name
-    xor the Chinese name with another row, but not both names,
-    and return a list of lists, where each list contains 2 strings, [0] 
-    for the English name and [1] for the Chinese.
+def find_possibly_dirty(street_names, name_to_index, index_to_name):
     '''
-    temp_list = []
-    official_list = []
-    root = ET.parse(street_name_file)
-    streets = root.findall('Row')
-    for street in streets:
-        eng_name = street.find('English_Street_Name').text
-        chi_name = street.find('Chinese_Street_Name').text
-        eng_name = string.capwords(eng_name)
-        # discard the rows with null values
-        if eng_name is not None and chi_name is not None:
-            official_list.append([eng_name, chi_name, False])
-    
-    # discard all but one of the identical copies (same English name and
-    # same Chinese name entries)
-    temp_list = []
-    for row in official_list:
-        if row not in temp_list:
-            temp_list.append(row)
-    official_list = temp_list
-    
-    # i_row[2] is a flag for the row to be deleted. These rows have
-    # either the same English name as other rows, or same Chinese
-    # name, but not both.
-    for i_row in official_list:
-        for j_row in official_list:
-            if (i_row[0] == j_row[0]) ^ (i_row[1] == j_row[1]):
-                i_row[2] = True
-    temp_list = []
-    for row in official_list:
-        if row[2] is False:
-            temp_list.append([row[0], row[1]])
-    official_list = temp_list
-    return official_list
-
-def create_lookups(official_list):
-    '''
-    Takes the processed official_list and returns two dicts.
-    name_to_index has the street names as keys, English and Chinese 
-    together, and the index numbers of the street names as values.
-    index_to_name has the index numbers as keys and dicts
-    {'eng': eng_name, 'chi': chi_name} as values
-    '''
-    name_to_index = {}
-    index_to_name = {}
-    for i in range(len(official_list)):
-        eng_name = official_list[i][0]
-        chi_name = official_list[i][1]
-        name_to_index[eng_name] = i
-        name_to_index[chi_name] = i
-        index_to_name[i] = {'eng': eng_name, 'chi': chi_name}
-    return name_to_index, index_to_name
-
-def is_street(way_tags):
-    '''
-    Takes a way_tags list(of a single way) from the function
-    shape_element(), and check if it is a road/street.
-    '''
-    for tag in way_tags:
-        if tag['key'] == 'highway' and tag['value'] in STREET_VALUES:
-            return True
-    return False
-
-def get_street_names(way_tags):
-    '''
-    Takes a way_tags list(of a single way) from the function
-    shape_element() and return the various versions of the name in a dict.
-    Called by street_dict_lookup(way_tags)
-    '''
-    osm_names = {}
-    for tag in way_tags:
-        if tag['key'] == 'en' and tag['type'] == 'name' :
-            osm_names['en_only'] = tag['value']
-        elif tag['key'] == 'zh' and tag['type'] == 'name':
-            osm_names['zh_only'] = tag['value']
-        elif tag['key'] == 'name' and tag['type'] == 'regular':
-            m = ENG_NAME_RE.search(tag['value'])
-            n = CHI_NAME_RE.search(tag['value'])
-            if m:
-                osm_names['reg_eng'] = m.group(1)
-            if n:
-                osm_names['reg_chi'] = n.group(1)
-    return osm_names
-
-def name_look_up(osm_names):
-    '''
-    Takes a dict of osm_names of a street, look up each name in the
-    name_to_index dict, and returns a set of all index numbers as well
-    as the number of times a name is not found in the index
-    '''
-    look_up_result_index = set()
-    not_found_count = 0
-    for version in osm_names:
-        if osm_names[version] in name_to_index:
-            look_up_result_index.add(name_to_index[osm_names[version]])
-        else:
-            not_found_count += 1
-    return look_up_result_index, not_found_count
-            
-def audit_bilingual_street_names(OSM_FILE):
-    '''
-    Takes the OSM_FILE, interate through the elements, and returns a
-    list of lists, where each element list is the various versions 
-    of the street's name, as well as the look up result from the
-    name_to_index lookups, of streets that fulfill the following 
-    conditions.
-    
+    Takes a list of the osm_names dicts of all the streets, look up all
+    the names in the name_to_index dict at once, and returns a list of
+    the various versions of the street's name, as well as the look up
+    result, of streets that fulfill the following conditions.
     
     - If the look up yielded exactly one result. Without manually
     checking each street or some extra data for cross reference, we 
@@ -246,33 +48,79 @@ def audit_bilingual_street_names(OSM_FILE):
     looking at perfect entries.
     '''
     possibly_dirty = []
-    
-    for element in get_element(OSM_FILE, tags=('way')):
-        way_tags = shape_element(element)['way_tags']
-        # Check if it's a street at all, if not skip this set of way tags
-        if is_street(way_tags):
-            osm_names = get_street_names(way_tags)
-            look_up_result_index, not_found_count = name_look_up(osm_names)
-            if (
-                (len(look_up_result_index) == 1)
-                and (not_found_count > 0 or len(osm_names) < 4)
-                ):
-                look_up_result_names = []
-                index = look_up_result_index.pop()
-                for name in (index_to_name[index].values()):
-                    look_up_result_names.append(name)
-                row_to_add = osm_names.copy()
-                row_to_add.update({'look_up_results': look_up_result_names})
-                possibly_dirty.append(row_to_add)
+    if not street_names or not name_to_index:
+        return possibly_dirty
+    official_names = pd.Index(list(name_to_index.keys()))
+    official_index = np.array(list(name_to_index.values()))
+    df = pd.DataFrame(street_names, columns=NAME_VERSIONS)
+    present = df.notnull().values
+
+    # The index number of each name, or -1 if it's missing or not found
+    # in name_to_index. One row per street, one column per name version.
+    found = np.column_stack([
+        np.where(positions >= 0, official_index[positions], -1)
+        for positions in (
+            official_names.get_indexer(df[version])
+            for version in NAME_VERSIONS
+        )
+    ])
+    hit = found >= 0
+    not_found_count = (present & ~hit).sum(axis=1)
+
+    # All the names found point to the same street if the lowest and the
+    # highest index numbers among them are the same
+    lowest = np.where(hit, found, len(index_to_name)).min(axis=1)
+    highest = found.max(axis=1)
+    one_result = hit.any(axis=1) & (lowest == highest)
+    dirty = one_result & (
+        (not_found_count > 0) | (present.sum(axis=1) < len(NAME_VERSIONS))
+    )
+
+    for i in np.flatnonzero(dirty):
+        index = int(highest[i])
+        row_to_add = street_names[i].copy()
+        row_to_add.update({
+            'look_up_results': list(index_to_name[index].values())
+        })
+        possibly_dirty.append(row_to_add)
     return possibly_dirty
 
-official_list = get_official_name_list(STREET_NAME_FILE)
-name_to_index, index_to_name = create_lookups(official_list)
-possibly_dirty = audit_bilingual_street_names(OSM_FILE)
-df = pd.DataFrame(possibly_dirty, columns = [
-    'en_only', 'reg_eng', 'zh_only', 'reg_chi', 'look_up_results'
-])
-pd.set_option('display.max_rows', 5000)
-pd.set_option('display.max_columns', 6)
-pd.set_option('display.max_colwidth', 35)
-print(df)
\ No newline at end of file
+def audit_bilingual_street_names(tag_iter, name_to_index, index_to_name):
+    '''
+    Takes the (element type, element id, tags) iterator from iter_tags(),
+    collects the names of all the streets, and returns a list of the
+    find_possibly_dirty() results.
+    '''
+    street_names = []
+    for element_type, _, way_tags in tag_iter:
+        if element_type != 'way':
+            continue
+        street, osm_names = get_street_names(way_tags)
+        # Check if it's a street at all, if not skip this set of way tags
+        if street:
+            street_names.append(osm_names)
+    return find_possibly_dirty(street_names, name_to_index, index_to_name)
+
+def print_possibly_dirty(possibly_dirty):
+    '''
+    Prints the possibly dirty street names as csv, with the English and
+    Chinese look up results separated by a semicolon.
+    '''
+    writer = csv.DictWriter(
+        sys.stdout, fieldnames=NAME_VERSIONS + ['look_up_results'],
+        lineterminator='\n'
+    )
+    writer.writeheader()
+    for row in possibly_dirty:
+        row = row.copy()
+        row['look_up_results'] = ';'.join(row['look_up_results'])
+        writer.writerow(row)
+
+if __name__ == '__main__':
+    name_to_index, index_to_name = create_lookups(
+        get_official_name_list(STREET_NAME_FILE)
+    )
+    possibly_dirty = audit_bilingual_street_names(
+        iter_tags(OSM_FILE, tags=('way',)), name_to_index, index_to_name
+    )
+    print_possibly_dirty(possibly_dirty)
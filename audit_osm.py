@@ -0,0 +1,79 @@
+# Run both audits of an OSM file in a single pass.
+# Target area is Hong Kong with a little bit of Shenzhen, PRC.
+#
+# Parsing the OSM file is by far the most expensive part of either
+# audit, so instead of running audit_bilingual_street_names.py and
+# audit_phone_numbers.py one after the other, we iterparse the file
+# once and hand the tags of each element to both audits.
+# Ways go to the street name audit and the phone number audit, nodes
+# only to the phone number audit.
+#
+# The file is split into shards that are parsed by a pool of worker
+# processes, one per core. The workers only collect the street names
+# and phone numbers, the official name look ups are then done all at
+# once in the main process.
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from osm_pipeline import (
+    create_lookups, get_official_name_list, get_street_names, iter_tags,
+    split_osm_file
+)
+from audit_bilingual_street_names import (
+    OSM_FILE, STREET_NAME_FILE, find_possibly_dirty, print_possibly_dirty
+)
+from audit_phone_numbers import find_phone_tags, print_phone_numbers
+
+
+def audit_shard(osm_file, shard):
+    '''
+    Takes an osm file and a shard from split_osm_file(), and returns the
+    osm_names of the streets and the possible phone numbers in it.
+    '''
+    street_names = []
+    possible_phone_numbers = []
+    for element_type, element_id, tags in iter_tags(osm_file, shard=shard):
+        if element_type == 'way':
+            # Both audits go through the tags of a way, so we have to
+            # keep them around instead of consuming them as they come
+            tags = tuple(tags)
+            street, osm_names = get_street_names(tags)
+            if street:
+                street_names.append(osm_names)
+        possible_phone_numbers.extend(find_phone_tags(element_id, tags))
+    return street_names, possible_phone_numbers
+
+def audit_osm(osm_file, name_to_index, index_to_name, workers=None):
+    '''
+    Takes an osm file, audit its shards in parallel with one process per
+    core (or workers processes), and returns the possibly dirty street
+    names and the possible phone numbers.
+    '''
+    if workers is None:
+        workers = os.cpu_count()
+    shards = split_osm_file(osm_file, workers)
+    street_names = []
+    possible_phone_numbers = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            audit_shard, [osm_file] * len(shards), shards
+        )
+        # map() gives the results back in the order of the shards
+        for shard_street_names, shard_phone_numbers in results:
+            street_names.extend(shard_street_names)
+            possible_phone_numbers.extend(shard_phone_numbers)
+    possibly_dirty = find_possibly_dirty(
+        street_names, name_to_index, index_to_name
+    )
+    return possibly_dirty, possible_phone_numbers
+
+if __name__ == '__main__':
+    name_to_index, index_to_name = create_lookups(
+        get_official_name_list(STREET_NAME_FILE)
+    )
+    possibly_dirty, possible_phone_numbers = audit_osm(
+        OSM_FILE, name_to_index, index_to_name
+    )
+    print_possibly_dirty(possibly_dirty)
+    print_phone_numbers(possible_phone_numbers)
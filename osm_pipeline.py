@@ -0,0 +1,314 @@
+# Shared parsing of an OSM file, for the audits and for
+# parse_clean_and_csv.py.
+# Target area is Hong Kong with a little bit of Shenzhen, PRC.
+#
+# Both audits only look at the tags of nodes and ways, so instead of
+# each of them parsing the whole file on its own, we parse it once here
+# and hand the tags of every element to whichever audit wants them.
+#
+# The official street names, and how the street names of a way are
+# found, are also here, so that the street name audit reports exactly
+# the names that parse_clean_and_csv.py goes on to fix.
+
+import functools
+import itertools
+import os
+import re
+import string
+from lxml import etree as ET
+import pandas as pd
+import regex
+
+# How many bytes of the osm file to read at a time. Parsing is the
+# bottleneck at this size, bigger reads (or an mmap, which lxml copies
+# out of anyway as it only parses bytes) don't make it any faster.
+READ_SIZE = 1 << 20
+
+# The start of a node, way or relation, where we can split the osm file.
+# A < can't appear unescaped in an attribute value, so this can only
+# match an actual element.
+ELEMENT_START_RE = re.compile(rb'<(?:node|way|relation)[\s/>]')
+# The longest run of bytes ELEMENT_START_RE could match part of, kept
+# from one read to the next so a match across two reads isn't missed
+ELEMENT_START_OVERLAP = len(b'<relation')
+# The open tag of the root element. Attribute values may have a > in
+# them, so it ends at the first > outside of quotes. Group 1 is the /
+# of an empty <osm/>.
+OSM_OPEN_TAG_RE = re.compile(
+    rb'<osm(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>'
+)
+
+# Tags with any of these characters in the key are skipped. Checking a
+# key against a set is much cheaper than running a regex on it.
+PROBLEMCHARS = frozenset('=+/&<>;\'"?%#$@,. \t\r\n')
+
+# The Chinese name is a run of Han characters, which may also have digits
+# and full width letters in it, e.g. 麒麟圍１巷 or 錦綉花園Ｂ段第一街
+CHI_NAME_PATTERN = r"(\p{Han}[\p{Han}\p{Nd}\uFF01-\uFF5E]*)"
+ENG_NAME_PATTERN = r"[ ]*([A-Za-z0-9'\-,. ]{4,})"
+# Both of them in one regex, so the value of a name tag is only scanned
+# once. Group 1 is the Chinese name and group 2 the English name.
+REG_NAME_RE = regex.compile(CHI_NAME_PATTERN + '|' + ENG_NAME_PATTERN)
+
+# These are possible values for an osm way with a tag with 'highway' 
+# as key, to be a government-named street.
+STREET_VALUES = frozenset([
+    'motorway', 'trunk', 'primary', 'secondary', 'tertiary', 
+    'residential',  'living_street', 'pedestrian', 'track', 
+    'road', 'steps', 'path'
+])
+
+
+def read_chunks(osm_file, start=0, end=None):
+    '''
+    Takes an osm file and yield its bytes from start to end (or to the
+    end of the file), READ_SIZE at a time.
+    '''
+    with open(osm_file, 'rb') as f:
+        f.seek(start)
+        position = start
+        while end is None or position < end:
+            size = READ_SIZE if end is None else min(READ_SIZE, end - position)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), shard=None):
+    """Yield element if it is the right type of tag"""
+
+    # We read the file in big chunks and feed them to a pull parser,
+    # instead of letting iterparse read it a few KB at a time.
+    # Every element directly under the root is cleared once it's done,
+    # and the siblings before it deleted, whether it's one of the tags
+    # we asked for or not, so memory stays flat over a large file. The
+    # tags and nds inside an element are left alone until then.
+    parser = ET.XMLPullParser(events=('end',), huge_tree=True)
+    if shard is None:
+        chunks = read_chunks(osm_file)
+    else:
+        # A shard from split_osm_file() is just a run of elements, so we
+        # wrap it in a root element of its own to make it valid XML
+        start, end = shard
+        chunks = itertools.chain(
+            [b'<osm>'], read_chunks(osm_file, start, end), [b'</osm>']
+        )
+    for chunk in chunks:
+        parser.feed(chunk)
+        for _, elem in parser.read_events():
+            parent = elem.getparent()
+            # skip the root itself and anything inside a top level element
+            if parent is None or parent.getparent() is not None:
+                continue
+            if elem.tag in tags:
+                yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+    parser.close()
+
+def find_element_start(f, position, end):
+    '''
+    Takes an osm file open in binary mode and returns the offset of the
+    first node, way or relation that starts at or after position, or end
+    if there is none before end.
+    '''
+    f.seek(position)
+    data_start = position
+    data = b''
+    while data_start < end:
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            break
+        data += chunk
+        m = ELEMENT_START_RE.search(data)
+        if m:
+            return min(data_start + m.start(), end)
+        kept = data[-ELEMENT_START_OVERLAP:]
+        data_start += len(data) - len(kept)
+        data = kept
+    return end
+
+def split_osm_file(osm_file, n_shards):
+    '''
+    Takes an osm file and returns a list of up to n_shards (start, end)
+    byte ranges that together cover all of its nodes, ways and relations.
+    The first range starts right after the <osm ...> open tag and every
+    other one at the beginning of a node, way or relation, so each can
+    be parsed on its own with get_element(osm_file, shard=(start, end)).
+    If the file can't be split, e.g. it's too small, there is just one
+    range with all of it.
+    Raises ValueError if the file has no <osm> root element.
+    '''
+    size = os.path.getsize(osm_file)
+    with open(osm_file, 'rb') as f:
+        # the elements start right after the <osm ...> open tag
+        m = OSM_OPEN_TAG_RE.search(f.read(READ_SIZE))
+        if m is None:
+            raise ValueError('no <osm> open tag in {0}'.format(osm_file))
+        if m.group(1):
+            # an empty <osm/> has no elements at all
+            return []
+        content_start = m.end()
+
+        # the elements end where the closing </osm> tag starts
+        f.seek(max(0, size - READ_SIZE))
+        tail_start = f.tell()
+        close = f.read().rfind(b'</osm>')
+        if close < 0:
+            raise ValueError('no closing </osm> tag in {0}'.format(osm_file))
+        end = tail_start + close
+
+        starts = [content_start]
+        for i in range(1, n_shards):
+            position = max(size * i // n_shards, starts[-1] + 1)
+            position = find_element_start(f, position, end)
+            if position < end:
+                starts.append(position)
+    return list(zip(starts, starts[1:] + [end]))
+
+def iter_way_tags(element):
+    '''
+    Takes a way element and yield a (type, key, value) tuple for each of
+    its tags, skipping keys with problem chars. The type is the part of
+    the key before the first colon, or 'regular' if there is no colon.
+    '''
+    for child in element:
+        if child.tag == 'tag':
+            k = child.attrib['k']
+            if PROBLEMCHARS.isdisjoint(k):
+                tag_type, colon, key = k.partition(':')
+                if colon:
+                    yield tag_type, key, child.attrib['v']
+                else:
+                    yield 'regular', k, child.attrib['v']
+
+# The tags of a node look just like those of a way
+iter_node_tags = iter_way_tags
+
+def iter_tags(osm_file, tags=('node', 'way'), shard=None):
+    '''
+    Takes an osm file, iterparse it once and yield (element type,
+    element id, tags) for each element, where tags is the generator from
+    iter_node_tags() or iter_way_tags(), yielding a (type, key, value)
+    tuple for each tag. The element is cleared as soon
+    as the loop moves on, so the tags have to be consumed before that.
+    Only the elements in shard are parsed if it is given.
+    '''
+    for element in get_element(osm_file, tags=tags, shard=shard):
+        element_id = element.attrib['id']
+        if element.tag == 'way':
+            yield element.tag, element_id, iter_way_tags(element)
+        else:
+            yield element.tag, element_id, iter_node_tags(element)
+
+def get_official_name_list(street_name_file):
+    '''
+    Takes the street names xml file from the HK government, 
+    1. parse it,
+    2. capitalize the first letter of each word
+    3. delete rows with null values,
+    4. delete duplicate rows and leaving only one copy,
+    5. delete rows that share the same value for either the English name
+    xor the Chinese name with another row, but not both names,
+    and return a list of lists, where each list contains 2 strings, [0] 
+    for the English name and [1] for the Chinese.
+    '''
+    official_list = []
+    root = ET.parse(street_name_file)
+    streets = root.findall('Row')
+    for street in streets:
+        eng_name = street.find('English_Street_Name').text
+        chi_name = street.find('Chinese_Street_Name').text
+        eng_name = string.capwords(eng_name)
+        # discard the rows with null values
+        if eng_name is not None and chi_name is not None:
+            official_list.append([eng_name, chi_name])
+    df = pd.DataFrame(official_list, columns=['eng', 'chi'])
+
+    # discard all but one of the identical copies (same English name and
+    # same Chinese name entries)
+    df = df.drop_duplicates()
+
+    # discard the rows that have either the same English name as other
+    # rows, or same Chinese name, but not both. With the identical copies
+    # gone, that is any row whose English or Chinese name appears more
+    # than once.
+    eng_counts = df.groupby('eng')['chi'].transform('size')
+    chi_counts = df.groupby('chi')['eng'].transform('size')
+    df = df[(eng_counts == 1) & (chi_counts == 1)]
+    return [
+        [eng_name, chi_name]
+        for eng_name, chi_name in zip(df['eng'], df['chi'])
+    ]
+
+def create_lookups(official_list):
+    '''
+    Takes the official_list and returns two dicts.
+    name_to_index has the street names as keys, English and Chinese 
+    together, and the index numbers of the street names as values.
+    index_to_name has the index numbers as keys and dicts
+    {'eng': eng_name, 'chi': chi_name} as values
+    '''
+    name_to_index = {}
+    index_to_name = {}
+    for i, (eng_name, chi_name) in enumerate(official_list):
+        name_to_index[eng_name] = i
+        name_to_index[chi_name] = i
+        index_to_name[i] = {'eng': eng_name, 'chi': chi_name}
+    return name_to_index, index_to_name
+
+# Many ways are segments of the same street with the same name tag, so
+# we remember the results instead of splitting the same value again
+@functools.lru_cache(maxsize=100000)
+def split_reg_name(value):
+    '''
+    Takes the value of a name tag, where the Chinese name is followed by
+    a space and then the English name, and returns the first English
+    name and the first Chinese name found in it. Either of them is None
+    if not found.
+    '''
+    reg_eng, reg_chi = None, None
+    for m in REG_NAME_RE.finditer(value):
+        chi_part, eng_part = m.groups()
+        if chi_part is not None:
+            if reg_chi is None:
+                reg_chi = chi_part
+        elif reg_eng is None:
+            reg_eng = eng_part
+    return reg_eng, reg_chi
+
+def get_street_names(way_tags):
+    '''
+    Takes the (type, key, value) tags of a single way, e.g. from
+    iter_way_tags(), check if it is a road/street and get the various
+    versions of the name in the same pass. Returns the check result and
+    the names in a dict.
+    '''
+    street = False
+    osm_names = {}
+    for tag_type, key, value in way_tags:
+        if key == 'highway':
+            if value in STREET_VALUES:
+                street = True
+            elif tag_type == 'regular':
+                # The highway tag itself decides. Most highways are
+                # service roads, footways and the like, so stop right
+                # there if it's not a street. This also overrides any
+                # prefixed highway tag, e.g. highway=construction with
+                # construction:highway=residential is not a street, in
+                # whatever order the tags come. Prefixed ones such as
+                # abandoned:highway or area:highway don't stop the scan.
+                return False, osm_names
+        elif key == 'en' and tag_type == 'name' :
+            osm_names['en_only'] = value
+        elif key == 'zh' and tag_type == 'name':
+            osm_names['zh_only'] = value
+        elif key == 'name' and tag_type == 'regular':
+            reg_eng, reg_chi = split_reg_name(value)
+            if reg_eng:
+                osm_names['reg_eng'] = reg_eng
+            if reg_chi:
+                osm_names['reg_chi'] = reg_chi
+    return street, osm_names
@@ -14,14 +14,19 @@
 
 
 import csv
-import codecs
+import os
 import pprint
 import re
-import xml.etree.cElementTree as ET
+import numpy as np
 import pandas as pd
-import string
 import cerberus
 import schema
+from concurrent.futures import ProcessPoolExecutor
+
+from osm_pipeline import (
+    create_lookups, get_element, get_official_name_list, get_street_names,
+    split_osm_file
+)
 
 OSM_FILE = 'Hong_Kong.osm'
 STREET_NAME_FILE = 'PSI_Street Name_062017.xml'
@@ -34,11 +39,9 @@ WAY_TAGS_PATH = 'ways_tags.csv'
 UPDATE_HISTORY_PATH = 'update_history.csv'
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
-PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
-FIRST_COLON_RE = re.compile(r'(.*?):(.*)$')
-
-CHI_NAME_RE = re.compile(r"([^A-Za-z'\-,. ]+[0-9]?[^A-Za-z'\-,. ]+)")
-ENG_NAME_RE = re.compile(r"[ ]*([A-Za-z0-9'\-,. ]{4,})")
+# Tags with any of these characters in the key are skipped. Checking a
+# key against a set is much cheaper than running a regex on it.
+PROBLEMCHARS = frozenset('=+/&<>;\'"?%#$@,. \t\r\n')
 
 # From the audit we know that phone numbers can include the following
 # characters:
@@ -51,10 +54,18 @@ ENG_NAME_RE = re.compile(r"[ ]*([A-Za-z0-9'\-,. ]{4,})")
 #     A (Chinese) full width cross sign ＋ (unicode 65291 in Dec) that is 
 #         presumably used instead of the regular ASCII plus sign. 
 # We'll first strip phone numbers of these characters and then use 
-# simpler regexes to format them
-HK_PHONE_STRIPPED_RE = re.compile(r'^(852)?(\d{8})$')
-PRC_CELL_STRIPPED_RE = re.compile(r'^(86)?(1[3-9]\d{9})$')
-SZ_LAND_STRIPPED_RE = re.compile(r'^(86)?0?(755)(\d{6,8})$')
+# simpler regexes to format them.
+# The Hong Kong, PRC cell phone and Shenzhen land line formats are tried
+# in that order in a single regex, and the named group that matched says
+# which one it is. The local number is prefixed with PHONE_PREFIXES of
+# that group.
+PHONE_STRIPPED_RE = re.compile(
+    r'^(?:(?:852)?(?P<hk>\d{8})'
+    r'|(?:86)?(?P<prc_cell>1[3-9]\d{9})'
+    r'|(?:86)?0?755(?P<sz_land>\d{6,8}))$'
+)
+PHONE_PREFIXES = {'hk': '+852 ', 'prc_cell': '+86 ', 'sz_land': '+86 755 '}
+PHONE_STRIPPED_LENGTHS = (8, 15)
 NON_DIGIT_CHAR_RE = re.compile(u'[- +)(＋]+')
 DELIMITERS_RE = re.compile(',|;')
 
@@ -66,18 +77,29 @@ WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 UPDATE_HISTORY_FIELDS = ['id', 'element_type', 'field_updated']
+# The fields of the node or way tuple from shape_element(), where a
+# missing attribute is None
+ATTRIB_FIELDS = {'node': NODE_FIELDS, 'way': WAY_FIELDS}
+# The fields of the tuples in each list of rows from shape_element()
+ROW_FIELDS = {
+    'node_tags': NODE_TAGS_FIELDS,
+    'way_nodes': WAY_NODES_FIELDS,
+    'way_tags': WAY_TAGS_FIELDS,
+}
 
-# These are possible values for an osm way with a tag with 'highway' 
-# as key, to be a government-named street.
-STREET_VALUES = [
-    'motorway', 'trunk', 'primary', 'secondary', 'tertiary', 
-    'residential',  'living_street', 'pedestrian', 'track', 
-    'road', 'steps', 'path'
-]
+# The csv files are written as utf-8 text, and the csv module does its
+# own newline handling. They are written with a 1 MB buffer instead of
+# the default 8 KB one.
+CSV_OPEN_ARGS = {'encoding': 'utf-8', 'newline': '', 'buffering': 1 << 20}
+
+# The osm file is processed in shards of about this many bytes, and the
+# rows for each csv file from a shard are written all at once with
+# writerows()
+SHARD_SIZE = 1 << 24
 
 # These are streets that have the same names as streets in Shenzhen, right
 # across the border that our osm file happen to include
-sz_street_names = [u'文昌街', u'福民路', u'福祥街', u'丹桂路']
+sz_street_names = frozenset([u'文昌街', u'福民路', u'福祥街', u'丹桂路'])
 to_change_in_official = {
     # Typos made by the Lands Department in the STREET_NAME_FILE
     'Aberdeent Tuntntel': 'Aberdeen Tunnel',
@@ -102,12 +124,29 @@ to_change_in_official = {
 # From the audit results and after some looking, we can conclude that 
 # if the key of a tag is in the following list and the value matches
 # any of the phone regexes, it's a phone number
-PHONE_KEYS = [
+PHONE_KEYS = frozenset([
     'phone', 'fax', 'whatsapp', 'mobile', 'telephone', 'operator', 'source'
-]
+])
 
 SCHEMA = schema.schema
 
+# The cerberus types and rules that compile_schema() knows how to check,
+# with a check for each type. bool is a subclass of int in Python, so
+# the numeric types compare the exact type to keep True and False out.
+# compile_schema() raises on a schema with anything else in it, which
+# can only be checked with cerberus, i.e. process_map(strict=True).
+SCHEMA_TYPES = {
+    'string': lambda value: isinstance(value, str),
+    'integer': lambda value: type(value) is int,
+    'float': lambda value: type(value) in (float, int),
+    'number': lambda value: type(value) in (int, float),
+    'boolean': lambda value: type(value) is bool,
+}
+COMPILED_RULES = frozenset(['type', 'required', 'coerce', 'nullable'])
+# The rules of the parts of an element (node, node_tags, etc.), each a
+# dict or a list of dicts
+COMPILED_PART_RULES = frozenset(['type', 'schema'])
+
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
@@ -117,8 +156,12 @@ def shape_element(element, node_attr_fields=NODE_FIELDS,
                   problem_chars=PROBLEMCHARS, default_tag_type='regular'):
     """Clean and shape node or way XML element to Python dict"""
 
-    node_attribs = {}
-    way_attribs = {}
+    # The node or way, its tags and way nodes are all tuples in the order
+    # of their fields, e.g. NODE_FIELDS and NODE_TAGS_FIELDS, ready for
+    # csv.writer.
+    # Look these up once instead of for every child and attribute
+    element_attrib = element.attrib
+    element_id = element_attrib['id']
     way_nodes = []
     # Handle secondary tags the same way for both node and way elements
     tags = []  
@@ -127,57 +170,50 @@ def shape_element(element, node_attr_fields=NODE_FIELDS,
     for child in element:
         if (
             child.tag == 'tag' 
-            and not PROBLEMCHARS.search(child.attrib['k'])
+            and problem_chars.isdisjoint(child.attrib['k'])
         ):
-            tag_dict = {}
-            tag_dict['id'] = element.attrib['id']
-            tag_dict['value'] = child.attrib['v']
-            m = FIRST_COLON_RE.search(child.attrib['k'])
-            if m:
-                tag_dict['key'] = m.group(2)
-                tag_dict['type'] = m.group(1)
+            # split the key on the first colon, if there is one
+            before, colon, after = child.attrib['k'].partition(':')
+            if colon:
+                tags.append((element_id, after, child.attrib['v'], before))
             else:
-                tag_dict['key'] = child.attrib['k']
-                tag_dict['type'] = 'regular'
-            tags.append(tag_dict)
+                tags.append(
+                    (element_id, before, child.attrib['v'], 'regular')
+                )
         if child.tag == 'nd':
-            way_node_dict = {}
-            way_node_dict['id'] = element.attrib['id']
-            way_node_dict['node_id'] = child.attrib['ref']
-            way_node_dict['position'] = position
+            way_nodes.append((element_id, child.attrib['ref'], position))
             position += 1
-            way_nodes.append(way_node_dict)
             
+    # csv.writer writes a missing attribute (None) as an empty string
+    get_attrib = element_attrib.get
     if element.tag == 'node':
-        for attribute_name in element.attrib:
-            if attribute_name in NODE_FIELDS:
-                node_attribs[attribute_name] = (
-                    element.attrib[attribute_name]
-                )
+        node_attribs = tuple([get_attrib(field) for field in node_attr_fields])
         return {'node': node_attribs, 'node_tags': tags}
     elif element.tag == 'way':
-        for attribute_name in element.attrib:
-            if attribute_name in WAY_FIELDS:
-                way_attribs[attribute_name] = (
-                    element.attrib[attribute_name]
-                )
+        way_attribs = tuple([get_attrib(field) for field in way_attr_fields])
         return {
             'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags
         }
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+def row_to_dict(fields, row):
+    """Turn a tuple row back into a dict, leaving out missing fields"""
+    return {
+        field: value for field, value in zip(fields, row) if value is not None
+    }
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
+    # The schema is written for dicts, so turn the tuple rows back into
+    # dicts before validating
+    element = {
+        name: (
+            [row_to_dict(ROW_FIELDS[name], row) for row in value]
+            if name in ROW_FIELDS else row_to_dict(ATTRIB_FIELDS[name], value)
+        )
+        for name, value in element.items()
+    }
     if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
+        field, errors = next(iter(validator.errors.items()))
         message_string = (
             "\nElement of type '{0}' has the following errors:\n{1}"
         )
@@ -185,229 +221,289 @@ def validate_element(element, validator, schema=SCHEMA):
         
         raise Exception(message_string.format(field, error_string))
 
+def compile_field(field, rules):
+    '''
+    Takes a field and its cerberus rules and returns a function
+    that takes a value of the field and returns a list of errors, empty
+    if there is none.
+    '''
+    is_expected_type = SCHEMA_TYPES.get(rules.get('type'), lambda value: True)
+    coerce = rules.get('coerce')
+    nullable = rules.get('nullable', False)
+
+    def check_field(value):
+        if value is None:
+            return [] if nullable else ['null value not allowed']
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except (TypeError, ValueError):
+                return ["field '{0}' cannot be coerced".format(field)]
+        if not is_expected_type(value):
+            return ['must be of {0} type'.format(rules['type'])]
+        return []
+    return check_field
+
+def compile_schema(schema):
+    '''
+    Takes the cerberus schema of the elements from shape_element(), walk
+    it once and returns a function that checks an element against it
+    with plain type checks, which is much faster than having cerberus
+    walk the schema again for every element. The function returns the
+    name and errors of the first part of the element that doesn't match,
+    or None.
+    Raises ValueError if the schema has any rule or type it can't check,
+    so the checks can never quietly fall short of the schema.
+    '''
+    def check_rules(name, rules, known_rules):
+        unknown = set(rules) - known_rules
+        if unknown:
+            raise ValueError(
+                "can't compile the rules {0} of '{1}', validate with "
+                "strict=True instead".format(sorted(unknown), name)
+            )
+
+    checks = {}
+    for name, rules in schema.items():
+        check_rules(name, rules, COMPILED_PART_RULES)
+        # the rows of a list are checked against the schema of its items
+        if rules.get('type') == 'list':
+            rules = rules.get('schema', {})
+            check_rules(name, rules, COMPILED_PART_RULES)
+        if rules.get('type') != 'dict':
+            raise ValueError(
+                "'{0}' must be a dict or a list of dicts".format(name)
+            )
+        fields = rules.get('schema', {})
+        for field, field_rules in fields.items():
+            check_rules(field, field_rules, COMPILED_RULES)
+            field_type = field_rules.get('type')
+            if field_type is not None and field_type not in SCHEMA_TYPES:
+                raise ValueError(
+                    "can't compile the type '{0}' of '{1}', validate with "
+                    "strict=True instead".format(field_type, field)
+                )
+            if not callable(field_rules.get('coerce', int)):
+                raise ValueError(
+                    "can't compile the coerce rule of '{0}', it must be a "
+                    "function".format(field)
+                )
+        field_checks = [
+            (field, compile_field(field, field_rules))
+            for field, field_rules in fields.items()
+        ]
+        required = frozenset(
+            field for field, field_rules in fields.items()
+            if field_rules.get('required', False)
+        )
+        checks[name] = (fields, field_checks, required)
+
+    def check_row(fields, field_checks, required, row):
+        errors = {}
+        for field in row:
+            if field not in fields:
+                errors[field] = ['unknown field']
+        for field, check_field in field_checks:
+            if field in row:
+                field_errors = check_field(row[field])
+                if field_errors:
+                    errors[field] = field_errors
+            elif field in required:
+                errors[field] = ['required field']
+        return errors
+
+    def fast_validate(element):
+        for name, value in element.items():
+            if name not in checks:
+                return name, ['unknown field']
+            fields, field_checks, required = checks[name]
+            if name in ROW_FIELDS:
+                # the tuple rows are in ROW_FIELDS order
+                for i, row in enumerate(value):
+                    errors = check_row(
+                        fields, field_checks, required,
+                        row_to_dict(ROW_FIELDS[name], row)
+                    )
+                    if errors:
+                        return name, [{i: [errors]}]
+            else:
+                errors = check_row(
+                    fields, field_checks, required,
+                    row_to_dict(ATTRIB_FIELDS[name], value)
+                )
+                if errors:
+                    return name, [errors]
+        return None
+    return fast_validate
+
+def fast_validate_element(element, fast_validate):
+    """Raise ValidationError if element fails the compiled schema checks"""
+    result = fast_validate(element)
+    if result is not None:
+        field, errors = result
+        message_string = (
+            "\nElement of type '{0}' has the following errors:\n{1}"
+        )
+        error_string = pprint.pformat(errors)
+        
+        raise Exception(message_string.format(field, error_string))
 
-class UnicodeDictWriter(csv.DictWriter, object):
-    """Extend csv.DictWriter to handle Unicode input"""
 
-    def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-            k: (v.encode('utf-8') if isinstance(v, unicode) else v) 
-            for k, v in row.iteritems()
-        })
+def init_worker(lookups):
+    """Set the official name look ups in a process_map() worker"""
+    global name_to_index, index_to_name
+    name_to_index, index_to_name = lookups
 
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+def process_shard(file_in, shard, validate, strict):
+    '''
+    Takes a shard of file_in from split_osm_file(), process each XML
+    element in it and returns the rows for each csv file, in a list of
+    lists in the order nodes, node tags, ways, way nodes, way tags and
+    update history.
+    '''
+    # Unless strict is True, elements are validated with the checks
+    # compiled from SCHEMA instead of cerberus
+    fast_validate = None
+    if validate is True and strict is not True:
+        fast_validate = compile_schema(SCHEMA)
+    validator = cerberus.Validator()
+
+    nodes_rows = []
+    node_tags_rows = []
+    ways_rows = []
+    way_nodes_rows = []
+    way_tags_rows = []
+    update_history_rows = []
+    # (element type, element id, start and end of its tags in the tag
+    # rows, whether its name was updated) of each element, in order
+    elements = []
+
+    for element in get_element(file_in, tags=('node', 'way'), shard=shard):
+        el = shape_element(element)
+        if el:
+            if fast_validate is not None:
+                fast_validate_element(el, fast_validate)
+            elif validate is True:
+                validate_element(el, validator)
+         
+            if element.tag == 'node':
+                start = len(node_tags_rows)
+                nodes_rows.append(el['node'])
+                node_tags_rows.extend(el['node_tags'])
+                elements.append((
+                    'node', el['node'][0], start, len(node_tags_rows), False
+                ))
+            elif element.tag == 'way':
+                tags, name_updated = fix_street_names(el['way_tags'])
+                start = len(way_tags_rows)
+                ways_rows.append(el['way'])
+                way_nodes_rows.extend(el['way_nodes'])
+                way_tags_rows.extend(tags)
+                elements.append((
+                    'way', el['way'][0], start, len(way_tags_rows),
+                    name_updated
+                ))
+
+    # The phone numbers of the whole shard are fixed at once. An element
+    # had its phone updated if any of its tags did, i.e. if the running
+    # count of updated tags goes up between its start and end.
+    node_tags_rows, node_tags_updated = fix_phones_in_tags(node_tags_rows)
+    way_tags_rows, way_tags_updated = fix_phones_in_tags(way_tags_rows)
+    updated_counts = {
+        'node': np.concatenate([[0], np.cumsum(node_tags_updated)]),
+        'way': np.concatenate([[0], np.cumsum(way_tags_updated)]),
+    }
+    for element_type, element_id, start, end, name_updated in elements:
+        counts = updated_counts[element_type]
+        if counts[end] > counts[start]:
+            update_history_rows.append((element_id, element_type, 'phone'))
+        if name_updated:
+            update_history_rows.append((element_id, element_type, 'name'))
+    return [
+        nodes_rows, node_tags_rows, ways_rows, way_nodes_rows,
+        way_tags_rows, update_history_rows
+    ]
 
 
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
+def process_map(file_in, validate, strict=False, workers=None):
     """Iteratively process each XML element and write to csv(s)"""
 
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file, \
-         codecs.open(UPDATE_HISTORY_PATH, 'w') as update_history_file:
-
-        nodes_writer = (
-            UnicodeDictWriter(nodes_file, NODE_FIELDS,
-                              lineterminator='\n')
-        )
-        node_tags_writer = (
-            UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS,
-                              lineterminator='\n')
-        )
-        ways_writer = (
-            UnicodeDictWriter(ways_file, WAY_FIELDS,
-                              lineterminator='\n')
-        )
-        way_nodes_writer = (
-            UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS,
-                              lineterminator='\n')
-        )
-        way_tags_writer = (
-            UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS,
-                              lineterminator='\n')
-        )
-        update_history_writer = (
-            UnicodeDictWriter(update_history_file, UPDATE_HISTORY_FIELDS,
-                              lineterminator='\n')
+    # The elements don't depend on each other, so the file is split into
+    # shards that are processed by a pool of worker processes, one per
+    # core (or workers processes). The rows of each shard are written in
+    # the order of the shards, so the csv files come out the same as if
+    # the file was processed in a single pass.
+    if workers is None:
+        workers = os.cpu_count()
+    n_shards = max(workers, os.path.getsize(file_in) // SHARD_SIZE + 1)
+    shards = split_osm_file(file_in, n_shards)
+
+    with open(NODES_PATH, 'w', **CSV_OPEN_ARGS) as nodes_file, \
+         open(NODE_TAGS_PATH, 'w', **CSV_OPEN_ARGS) as nodes_tags_file, \
+         open(WAYS_PATH, 'w', **CSV_OPEN_ARGS) as ways_file, \
+         open(WAY_NODES_PATH, 'w', **CSV_OPEN_ARGS) as way_nodes_file, \
+         open(WAY_TAGS_PATH, 'w', **CSV_OPEN_ARGS) as way_tags_file, \
+         open(UPDATE_HISTORY_PATH, 'w', **CSV_OPEN_ARGS) \
+             as update_history_file:
+
+        nodes_writer = csv.writer(nodes_file, lineterminator='\n')
+        node_tags_writer = csv.writer(nodes_tags_file, lineterminator='\n')
+        ways_writer = csv.writer(ways_file, lineterminator='\n')
+        way_nodes_writer = csv.writer(way_nodes_file, lineterminator='\n')
+        way_tags_writer = csv.writer(way_tags_file, lineterminator='\n')
+        update_history_writer = csv.writer(
+            update_history_file, lineterminator='\n'
         )
 
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-        update_history_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-             
-                phone_updated = False
-                name_updated = False
-                if element.tag == 'node':
-                    tags = el['node_tags']
-                    tags, phone_updated = fix_phones_in_tags(tags)
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(tags)
-                    if phone_updated:
-                        node_id = el['node']['id']
-                        update_history_writer.writerow({
-                            'id': node_id,
-                            'element_type': 'node',
-                            'field_updated': 'phone'
-                        })
-                elif element.tag == 'way':
-                    tags = el['way_tags']
-                    tags, phone_updated = fix_phones_in_tags(tags)
-                    tags, name_updated = fix_street_names(tags)
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(tags)
-                    if phone_updated:
-                        way_id = el['way']['id']
-                        update_history_writer.writerow({
-                            'id': way_id,
-                            'element_type': 'way',
-                            'field_updated': 'phone'
-                        })
-                    if name_updated:
-                        way_id = el['way']['id']
-                        update_history_writer.writerow({
-                            'id': way_id,
-                            'element_type': 'way',
-                            'field_updated': 'name'
-                        })
+        nodes_writer.writerow(NODE_FIELDS)
+        node_tags_writer.writerow(NODE_TAGS_FIELDS)
+        ways_writer.writerow(WAY_FIELDS)
+        way_nodes_writer.writerow(WAY_NODES_FIELDS)
+        way_tags_writer.writerow(WAY_TAGS_FIELDS)
+        update_history_writer.writerow(UPDATE_HISTORY_FIELDS)
+
+        # in the same order as the lists of rows from process_shard()
+        writers = [
+            nodes_writer, node_tags_writer, ways_writer, way_nodes_writer,
+            way_tags_writer, update_history_writer
+        ]
+
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker,
+            initargs=((name_to_index, index_to_name),)
+        ) as executor:
+            results = executor.map(
+                process_shard, [file_in] * len(shards), shards,
+                [validate] * len(shards), [strict] * len(shards)
+            )
+            for shard_rows in results:
+                for writer, rows in zip(writers, shard_rows):
+                    writer.writerows(rows)
 
 # ================================================== #
 #      Functions for the official name dictionary    #
 # ================================================== #
 
-def get_official_name_list(street_name_file):
-    '''
-    Takes the street names xml file from the HK government, 
-    1. parse it,
-    2. capitalize the first letter of each word
-    3. delete rows with null values,
-    4. delete duplicate rows and leaving only one copy,
-    5. delete rows that share the same value for either the English name
-    xor the Chinese name with another row, but not both names,
-    and return a list of lists, where each list contains 2 strings, [0] 
-    for the English name and [1] for the Chinese.
-    '''
-    temp_list = []
-    official_list = []
-    root = ET.parse(street_name_file)
-    streets = root.findall('Row')
-    for street in streets:
-        eng_name = street.find('English_Street_Name').text
-        chi_name = street.find('Chinese_Street_Name').text
-        eng_name = string.capwords(eng_name)
-        # discard the rows with null values
-        if eng_name is not None and chi_name is not None:
-            official_list.append([eng_name, chi_name, False])
-    
-    # discard all but one of the identical copies (same English name and
-    # same Chinese name entries)
-    temp_list = []
-    for row in official_list:
-        if row not in temp_list:
-            temp_list.append(row)
-    official_list = temp_list
-    
-    # i_row[2] is a flag for the row to be deleted. These rows have
-    # either the same English name as other rows, or same Chinese
-    # name, but not both.
-    for i_row in official_list:
-        for j_row in official_list:
-            if (i_row[0] == j_row[0]) ^ (i_row[1] == j_row[1]):
-                i_row[2] = True
-    temp_list = []
-    for row in official_list:
-        if row[2] is False:
-            temp_list.append([row[0], row[1]])
-    official_list = temp_list
-    return official_list
-
 def update_official_list(official_list):
     '''
     Takes the street_name_list, update the names according to the 
     to_change_in_official, and discard those listed in sz_street_names, 
     and return the street_name_list updated.
     '''
-    temp_list = []
-    for row in official_list:
-        for i in range(2):
-            if row[i] in to_change_in_official:
-                row[i] = to_change_in_official[row[i]]
-        if row[1] not in sz_street_names:
-            temp_list.append(row)
-    official_list = temp_list
-    return official_list
-
-def create_lookups(official_list):
-    '''
-    Takes the processed official_list and returns two dicts.
-    name_to_index has the street names as keys, English and Chinese 
-    together, and the index numbers of the street names as values.
-    index_to_name has the index numbers as keys and dicts
-    {'eng': eng_name, 'chi': chi_name} as values
-    '''
-    name_to_index = {}
-    index_to_name = {}
-    for i in range(len(official_list)):
-        eng_name = official_list[i][0]
-        chi_name = official_list[i][1]
-        name_to_index[eng_name] = i
-        name_to_index[chi_name] = i
-        index_to_name[i] = {'eng': eng_name, 'chi': chi_name}
-    return name_to_index, index_to_name
+    changed = to_change_in_official.get
+    official_list = [
+        [changed(eng_name, eng_name), changed(chi_name, chi_name)]
+        for eng_name, chi_name in official_list
+    ]
+    return [row for row in official_list if row[1] not in sz_street_names]
 
 # ================================================== #
 #          Functions for fixing street names         #
 # ================================================== #
 
-def is_street(way_tags):
-    '''
-    Takes a way_tags list(of a single way) from the function
-    shape_element(), and check if it is a road/street.
-    '''
-    for tag in way_tags:
-        if tag['key'] == 'highway' and tag['value'] in STREET_VALUES:
-            return True
-    return False
-
-def get_street_names(way_tags):
-    '''
-    Takes a way_tags list(of a single way) from the function
-    shape_element() and return the various versions of the name in a dict.
-    Called by street_dict_lookup(way_tags)
-    '''
-    osm_names = {}
-    for tag in way_tags:
-        if tag['key'] == 'en' and tag['type'] == 'name' :
-            osm_names['en_only'] = tag['value']
-        elif tag['key'] == 'zh' and tag['type'] == 'name':
-            osm_names['zh_only'] = tag['value']
-        elif tag['key'] == 'name' and tag['type'] == 'regular':
-            m = ENG_NAME_RE.search(tag['value'])
-            n = CHI_NAME_RE.search(tag['value'])
-            if m:
-                osm_names['reg_eng'] = m.group(1)
-            if n:
-                osm_names['reg_chi'] = n.group(1)
-    return osm_names
-
 def name_look_up(osm_names):
     '''
     Takes a dict of osm_names of a street, look up each name in the
@@ -426,11 +522,17 @@ def name_look_up(osm_names):
 def fix_street_names(way_tags):
     '''
     Takes a list of way_tags and update the names if it's a street
-    if possible, and add tags if any of the name tags is missing
+    if possible, and add tags if any of the name tags is missing.
+    Whether it's a street is decided by get_street_names(), so a way
+    with a plain highway tag that isn't a street, e.g.
+    highway=construction, is left alone even if it also has a prefixed
+    one like construction:highway=residential.
     '''
     updated = False
-    if is_street(way_tags):
-        osm_names = get_street_names(way_tags)
+    street, osm_names = get_street_names(
+        (tag_type, key, value) for _, key, value, tag_type in way_tags
+    )
+    if street:
         look_up_result_index, not_found_count = name_look_up(osm_names)
     else:
         return way_tags, updated
@@ -441,99 +543,113 @@ def fix_street_names(way_tags):
         return way_tags, updated
     
     index = look_up_result_index.pop()
-    way_id = way_tags[0]['id']
+    way_id = way_tags[0][0]
     eng_name = index_to_name[index]['eng']
-    chi_name = unicode(index_to_name[index]['chi'])
+    chi_name = index_to_name[index]['chi']
     reg_name = chi_name + ' ' + eng_name
     eng_missing, chi_missing, reg_missing = True, True, True
     
     # overwrite with the official name if the tag exist
-    for tag in way_tags:
-        if tag['type'] == 'name' and tag['key'] == 'en':
-            if tag['value'] != eng_name:
+    for i, (tag_id, key, value, tag_type) in enumerate(way_tags):
+        if tag_type == 'name' and key == 'en':
+            if value != eng_name:
                 updated = True
-                tag['value'] = eng_name
+                way_tags[i] = (tag_id, key, eng_name, tag_type)
             eng_missing = False
-        if tag['type'] == 'name' and tag['key'] == 'zh':
-            if tag['value'] != chi_name:
+        if tag_type == 'name' and key == 'zh':
+            if value != chi_name:
                 updated = True
-                tag['value'] = chi_name
+                way_tags[i] = (tag_id, key, chi_name, tag_type)
             chi_missing = False
-        if tag['type'] == 'regular' and tag['key'] == 'name':
-            if tag['value'] != reg_name:
+        if tag_type == 'regular' and key == 'name':
+            if value != reg_name:
                 updated = True
-                tag['value'] = reg_name
+                way_tags[i] = (tag_id, key, reg_name, tag_type)
             reg_missing = False
     
     # if they don't, we add the tag
     if eng_missing:
-        way_tags.append({
-            'id': way_id, 'type': 'name', 'key': 'en', 'value': eng_name
-        })
+        way_tags.append((way_id, 'en', eng_name, 'name'))
         updated = True
     if chi_missing:
-        way_tags.append({
-            'id': way_id, 'type': 'name', 'key': 'zh', 'value': chi_name
-        })
+        way_tags.append((way_id, 'zh', chi_name, 'name'))
         updated = True
     if reg_missing:
-        way_tags.append({
-            'id': way_id, 'type': 'regular', 'key': 'name',
-            'value': reg_name
-        })
+        way_tags.append((way_id, 'name', reg_name, 'regular'))
         updated = True
     return way_tags, updated
 
 # ================================================== #
 #       Functions for fixing phone numbers           #
 # ================================================== #
-def fix_phone_value(in_string):
+def fix_phone_values(values):
     '''
-    Takes a phone number value that may contain multiple numbers 
-    separated by commas or semicolons, change them to the format
-    recommended by OSM and return.
+    Takes a pandas Series of phone number values that may each contain
+    multiple numbers separated by commas or semicolons, change them all
+    at once to the format recommended by OSM and returns the new values
+    and whether each one of them was updated, as two Series with the
+    same index as values.
     '''
-    phone_list = []
-    out_string = ''
-    for value in DELIMITERS_RE.split(in_string):
-        stripped = re.sub(NON_DIGIT_CHAR_RE, '', value)
-        m = HK_PHONE_STRIPPED_RE.search(stripped)
-        if m:
-            phone_list.append('+852 ' + m.group(2))
-            continue
-
-        m = PRC_CELL_STRIPPED_RE.search(stripped)
-        if m:
-            phone_list.append('+86 ' + m.group(2))
-            continue
-        m = SZ_LAND_STRIPPED_RE.search(stripped)
-        if m:
-            phone_list.append('+86 755 ' + m.group(3))
-    if phone_list:
-        for phone_number in phone_list:
-            out_string = out_string + phone_number + ';'
-        out_string = out_string[:-1]
-    else:
-        out_string = in_string
-    if in_string == out_string:
-        updated = False
-    else:
-        updated = True
-    return out_string, updated
+    # Many values under PHONE_KEYS (e.g. source and operator) have no
+    # digits at all, so they can't have a phone number in them
+    has_digit = values.str.contains(r'\d', regex=True)
+    # one row per number, with the index of the value it came from
+    numbers = values[has_digit].str.split(DELIMITERS_RE, regex=True)
+    numbers = numbers.explode()
+    stripped = numbers.str.replace(NON_DIGIT_CHAR_RE, '', regex=True)
+    # Anything PHONE_STRIPPED_RE can match starts with a digit and has 8
+    # to 14 of them (and the newline its $ allows at the end), so only
+    # those are run through the regex
+    lengths = stripped.str.len()
+    stripped = stripped[
+        (lengths >= PHONE_STRIPPED_LENGTHS[0])
+        & (lengths <= PHONE_STRIPPED_LENGTHS[1])
+        & stripped.str[:1].str.isdigit()
+    ]
+    # one column per named group, only the one that matched is filled
+    matched = stripped.str.extract(PHONE_STRIPPED_RE)
+    formatted = None
+    for number_format, prefix in PHONE_PREFIXES.items():
+        with_prefix = prefix + matched[number_format]
+        if formatted is None:
+            formatted = with_prefix
+        else:
+            formatted = formatted.fillna(with_prefix)
+
+    # values without a single phone number in them are left as they are
+    joined = formatted.dropna().groupby(level=0).agg(';'.join)
+    fixed = joined.reindex(values.index).fillna(values)
+    return fixed, fixed != values
 
 def fix_phones_in_tags(tags):
     '''
     Takes a list of tags and for every key in PHONE_KEYS, update the 
-    corresponding value with the fix_phone_value() function.    
-    To be called in the process_map() function.
+    corresponding value with the fix_phone_values() function, all in one
+    go. Returns the tags and a numpy array of whether each of them was
+    updated.
+    To be called in the process_shard() function.
     '''
-    updated = False
-    for tag in tags:
-        if tag['key'] in PHONE_KEYS:
-            tag['value'], updated = fix_phone_value(tag['value'])
+    updated = np.zeros(len(tags), dtype=bool)
+    phone_positions = [
+        i for i, (_, key, _, _) in enumerate(tags) if key in PHONE_KEYS
+    ]
+    if not phone_positions:
+        return tags, updated
+    # object dtype, so that the str methods use the re module, same as
+    # the regexes were written for
+    values = pd.Series(
+        [tags[i][2] for i in phone_positions], index=phone_positions,
+        dtype=object
+    )
+    fixed, phone_updated = fix_phone_values(values)
+    for i, value in fixed.items():
+        tag_id, key, _, tag_type = tags[i]
+        tags[i] = (tag_id, key, value, tag_type)
+    updated[phone_positions] = phone_updated.values
     return tags, updated
 
-official_list = get_official_name_list(STREET_NAME_FILE)
-official_list = update_official_list(official_list)
-name_to_index, index_to_name = create_lookups(official_list)
-process_map(OSM_FILE, validate = False)
+if __name__ == '__main__':
+    official_list = get_official_name_list(STREET_NAME_FILE)
+    official_list = update_official_list(official_list)
+    name_to_index, index_to_name = create_lookups(official_list)
+    process_map(OSM_FILE, validate = False)